@@ -6,13 +6,12 @@ wget http://[your_IP]:8001/sniffserver.json
 
 import json, time
 
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
 def register_histogram(sequence):
-    register_to_count = {}
-    for (ts, regname, index, changes) in sequence:
-        count = register_to_count.get(regname, 0)
-        register_to_count[regname] = count + 1
-    c = sorted([(count, reg) for (reg, count) in register_to_count.items()])
-    return [(reg, count) for (count, reg) in c]
+    register_to_count = Counter(regname for (ts, regname, index, changes) in sequence)
+    return sorted(register_to_count.items(), key=lambda rc: (rc[1], rc[0]))
 
 def print_register_histogram(seq, key=None):
     duration = seq[-1][0] - seq[0][0]
@@ -27,20 +26,27 @@ def print_register_histogram(seq, key=None):
     return hist
 
 def print_byte_histogram(sequence, register):
-    pos_to_bytes = {}
+    # partition by type of changes once so the byte loop below has no branches
+    bytechanges, otherchanges = [], []
     for (ts, regname, index, changes) in sequence:
         if register == regname and changes:
             if isinstance(changes, list):
-                for (pos, old, new) in changes:
-                    b = pos_to_bytes.get(pos)
-                    if b is None:
-                        b = [old]
-                        pos_to_bytes[pos] = b
-                    b.append(new)
-            elif isinstance(changes, str):
-                print(f'{changes} at {time.ctime(ts)}')
+                bytechanges.append(changes)
             else:
-                print(f'more than {changes} changes at {time.ctime(ts)}')
+                otherchanges.append((ts, changes))
+    for (ts, changes) in otherchanges:
+        if isinstance(changes, str):
+            print(f'{changes} at {time.ctime(ts)}')
+        else:
+            print(f'more than {changes} changes at {time.ctime(ts)}')
+    pos_to_bytes = {}
+    for changes in bytechanges:
+        for (pos, old, new) in changes:
+            b = pos_to_bytes.get(pos)
+            if b is None:
+                b = [old]
+                pos_to_bytes[pos] = b
+            b.append(new)
     h = sorted([(len(b), pos, b) for (pos, b) in pos_to_bytes.items()])
     for (count, pos, b) in h:
         print(f'{register} byte offset {pos}: {count} changes: {b}')
@@ -59,26 +65,28 @@ def print_byte_changes(sequence, register, pos, key=None):
     if not time_byte:
         print(f'{key}: {register} offset {pos} did not change')
         return time_byte
-    print(f'{key}: {register} byte offset {pos} had initial value {hex(oldest)}')
+    lines = [f'{key}: {register} byte offset {pos} had initial value {hex(oldest)}']
     last_ts = 0
     for (ts, b) in time_byte:
         if last_ts:
-            print(f'{time.ctime(ts)} ({round(ts-last_ts, 1)} sec): {hex(b)}')
+            lines.append(f'{time.ctime(ts)} ({round(ts-last_ts, 1)} sec): {hex(b)}')
         else:
-            print(f'{time.ctime(ts)} (initial): {hex(b)}')
+            lines.append(f'{time.ctime(ts)} (initial): {hex(b)}')
         last_ts = ts
+    print('\n'.join(lines))
     return time_byte
 
 # you'll need to change this filename to be a filename you have...
 
-js = json.load(open('sniffserver-15Aug-hot-day-w-writes.json'))
+with open('sniffserver-15Aug-hot-day-w-writes.json', 'rb') as f:
+    js = json.load(f)
 loseq = js['system1']['sequence']
 upseq = js['system2']['sequence']
 
 system1 = register_histogram(loseq)
 system2 = register_histogram(upseq)
-lset = set([r for (r, c) in system1])
-uset = set([r for (r, c) in system2])
+lset = {r for (r, c) in system1}
+uset = {r for (r, c) in system2}
 
 
 first = min(upseq[0][0], loseq[0][0])
@@ -103,12 +111,16 @@ print_byte_changes(loseq, 'AirHandler06(0306)', 3, key='system1')
 # possible settings change time.
 
 def time_bounded_sequence(seq, earliest=0, latest=time.time()):
-    start_condition = {v[1]: v for v in seq if v[0] < earliest}
+    # seq is in timestamp order, so binary search finds the cut points
+    timestamps = [v[0] for v in seq]
+    first = bisect_left(timestamps, earliest)
+    last = bisect_right(timestamps, latest)
+    start_condition = {v[1]: v for v in seq[:first]}
     end_condition = {}
-    for v in seq:
-        if v[0] > latest and v[1] not in end_condition:
+    for v in seq[last:]:
+        if v[1] not in end_condition:
             end_condition[v[1]] = v
-    return [v for v in start_condition.values()] + [v for v in seq if v[0] >= earliest and v[0] <= latest] + [v for v in end_condition.values()]
+    return [v for v in start_condition.values()] + seq[first:last] + [v for v in end_condition.values()]
 
 s = time_bounded_sequence(upseq, 1628904298, 1628904298+240)
 print_register_histogram(s, 'living')
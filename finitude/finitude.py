@@ -8,9 +8,11 @@ Prometheus can query us very often (every second if desired) because we are
 constantly listening to the HVAC's RS-485 bus and updating our internal state.
 """
 
-import logging, prometheus_client, re, threading, time, yaml
+import functools, logging, prometheus_client, re, threading, time, yaml
 
-from queue import SimpleQueue, Empty
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, SimpleQueue, Empty, Full
 
 from . import frames
 from . import registers
@@ -23,6 +25,84 @@ class RequestError(Exception):
 
 LOGGER = logging.getLogger('finitude')
 
+ZONE_RE = re.compile(r'Zone([1-8])(.*)')
+
+
+@functools.lru_cache(maxsize=None)
+def _zone_item(itemname):
+    """Returns (zone, itemname without the zone) for an item like Zone3Name,
+    or (None, itemname) for an item that is not per-zone.
+    """
+    if itemname.startswith('Zone'):
+        zmatch = ZONE_RE.match(itemname)
+        if zmatch:
+            return (int(zmatch.group(1)), zmatch.group(2))
+    return (None, itemname)
+
+
+@functools.lru_cache(maxsize=None)
+def _gauge_name(tablename, itemname):
+    """Returns (gaugename, zone, divisor) for an item in a register table.
+    The same few dozen items arrive in every frame, so we mangle each
+    name only once.
+    """
+    divisor = 1
+    (pre, times, post) = itemname.partition('Times7')
+    if times and not post:
+        itemname = pre
+        divisor = 7.0
+    (pre, times, post) = itemname.partition('Times16')
+    if times and not post:
+        itemname = pre
+        divisor = 16.0
+    for words in ['RPM', 'CFM']:
+        (pre, word, post) = itemname.partition(words)
+        if word:
+            itemname = f'{pre}{"_" if pre else ""}{word.lower()}{"_" if post else ""}{post}'
+            break
+    (zone, iname) = _zone_item(itemname)
+    if tablename:
+        gaugename = f'finitude_{tablename}_{iname.lower()}'
+    else:
+        gaugename = f'finitude_{iname}'
+    return (gaugename.replace('(', '').replace(')', ''), zone, divisor)
+
+
+def _flatten_items(values):
+    """Yields (itemname, value, labelpair) for each item in a register table.
+    A list of tagged tables becomes one item per field of each table,
+    labeled with its tag.
+    """
+    for (itemname, v) in values.items():
+        if isinstance(v, list):
+            if v and (v[0].get('Tag') is not None):
+                for d in v:
+                    labelpair = ('tag', str(d['Tag']))
+                    for (subkey, val) in d.items():
+                        if subkey != 'Tag':
+                            yield (f'{itemname}_{subkey}', val, labelpair)
+        else:
+            yield (itemname, v, None)
+
+
+def _decode_mode(v):
+    """Decodes a Mode value into (mode name, mode, stage, state, state enum).
+    The lower 5 bits are the mode; upper bits are stage number. Returns None
+    if the mode is invalid.
+    """
+    try:
+        mode = registers.HvacMode(v & 0x1f)
+    except ValueError:
+        return None
+    stage = v >> 5
+    # FIXME: state and enum are incorrect if mode is AUTO and we are cooling
+    state = stage * (-1 if mode == registers.HvacMode.COOL else 1)
+    s = 'off' if state == 0 else 'cool' if state < 0 else 'heat'
+    return (mode.name, int(mode), stage, state, s)
+
+# Mode is a single byte, so every value it can take is decoded up front
+_MODE_TABLE = [_decode_mode(v) for v in range(256)]
+
 
 class HvacMonitor:
     FRAME_COUNT = prometheus_client.Counter('finitude_frames',
@@ -47,6 +127,10 @@ class HvacMonitor:
     TEMPSENSORS = prometheus_client.Gauge('finitude_temp_sensor',
                                           'temp reported by sensor',
                                           ['name', 'device', 'state', 'sensor_type'])
+    MODE = prometheus_client.Gauge('finitude_mode', 'current operating mode',
+                                   ['name', 'state'])
+    STAGE = prometheus_client.Gauge('finitude_stage', 'current operating stage', ['name'])
+    STATE = prometheus_client.Gauge('finitude_state', 'current operating state', ['name'])
     TABLE_NAME_MAP = {
         'AirHandler06': 'airhandler',
         'AirHandler16': 'airhandler',
@@ -56,9 +140,21 @@ class HvacMonitor:
         'HeatPump01': 'heatpump',
         'HeatPump02': 'heatpump',
         }
+    SENSOR_STATES = { 1: 'present', 4: 'missing' }
+    SENSOR_TYPES = {
+        0x11: 'OAT',
+        0x12: 'OCT',
+        0x14: 'LAT',
+        0x1c: 'HPT',
+        0x30: 'suction',
+        0x45: 'discharge',
+        0x4a: 'superheat',
+        }
+    SENSOR_TYPES.update({ z: f'Zone{z}' for z in range(1, 9) })
     GAUGES = {}
     CV = threading.Condition()
     NUM_ZONES = 8
+    MAX_SEQUENCE_LENGTH = 65536  # oldest stored frames are dropped past this
 
     def __init__(self, name, path):
         self.name, self.path = name, path
@@ -66,12 +162,23 @@ class HvacMonitor:
         self.synchronized = False
         self.pending_frame = None
         self.send_queue = SimpleQueue()
+        # bounded, so a processor that falls behind pushes back on the reader
+        self.frame_queue = Queue(maxsize=256)
 
         self.register_to_rest = {}
         self.framedata_to_index = {}
-        self.frames = []  # squashed
+        self.frames = deque(maxlen=HvacMonitor.MAX_SEQUENCE_LENGTH)  # squashed
         self.store_frames = False
         self.zone_to_name = ['' for x in range(HvacMonitor.NUM_ZONES)]
+        # (child, divisor) for each numeric item we have set before, so each
+        # item costs a dict lookup instead of resolving its gauge again
+        self.gauge_setters = {}
+        self.frame_counters = {}
+        # children of the metrics that are labeled only by monitor name
+        self.frame_count = None  # bound on first use, only if not storing frames
+        self.desync_count = HvacMonitor.DESYNC_COUNT.labels(name=self.name)
+        self.reconnect_count = HvacMonitor.RECONNECT_COUNT.labels(name=self.name)
+        self.mode_metrics = None  # (stage, state, state enum), bound on the first Mode
         HvacMonitor.IS_SYNC.labels(name=self.name).set_function(lambda s=self: s.synchronized)
         HvacMonitor.STORED_FRAMES.labels(name=self.name).set_function(lambda s=self: len(s.framedata_to_index))
         HvacMonitor.FRAME_SEQUENCE_LENGTH.labels(name=self.name).set_function(lambda s=self: len(s.frames))
@@ -81,10 +188,9 @@ class HvacMonitor:
         self.stream = frames.StreamFactory(self.path)
         self.bus = frames.Bus(self.stream, report_crc_error=self._report_crc_error)
 
-        HvacMonitor.RECONNECT_COUNT.labels(name=self.name).inc()
+        self.reconnect_count.inc()
 
     def process_frame(self, frame):
-        self.synchronized = True
         is_write = frame.func == frames.Function.WRITE
         is_ack = frame.func == frames.Function.ACK06
         if frame.length >= 3 and (is_write or is_ack):
@@ -95,54 +201,53 @@ class HvacMonitor:
                 values = { 'ERROR': f'parsing: {e}' }
                 rest = frame.data
                 LOGGER.warning(f'failed to parse {name} with {rest}: {e}')
-            (basename, paren, num) = name.partition('(')
             addr = frame.source if is_ack else frame.dest
             if values:
-                if name == 'DeviceInfo(0104)':
-                    if is_ack:
-                        sa = frames.ParsedFrame.get_printable_address(frame.source)
-                        self.DEVINFO.labels(name=self.name, device=sa).info(values)
-                elif name == 'Temperatures(0302)':
-                    for s in values['TempSensors']:
-                        sa = frames.ParsedFrame.get_printable_address(frame.source)
-                        if s['State'] == 1:
-                            state = 'present'
-                        elif s['State'] == 4:
-                            state = 'missing'
-                        else:
-                            state = str(s['State'])
-                        if s['Type'] >= 1 and s['Type'] <= 8:
-                            stype = f'Zone{s["Type"]}'
-                        elif s['Type'] == 0x11:
-                            stype = 'OAT'
-                        elif s['Type'] == 0x12:
-                            stype = 'OCT'
-                        elif s['Type'] == 0x14:
-                            stype = 'LAT'
-                        elif s['Type'] == 0x1c:
-                            stype = 'HPT'
-                        elif s['Type'] == 0x30:
-                            stype = 'suction'
-                        elif s['Type'] == 0x45:
-                            stype = 'discharge'
-                        elif s['Type'] == 0x4a:
-                            stype = 'superheat'
-                        else:
-                            stype = str(s['Type'])
-                        temp = s['TempTimes16']
-                        self.TEMPSENSORS.labels(
-                            name=self.name, device=sa, state=state, sensor_type=stype
-                        ).set(temp / 16.0)
-                else:
-                    tablename = self.TABLE_NAME_MAP.get(basename, basename)
-                    for (k, v) in values.items():
-                        if is_ack and name == 'TStatZoneParams(3b03)':
-                            self._set_zonename(k, v)
-                        self._set_gauge(tablename, k, v)
+                handler = HvacMonitor._HANDLERS.get(name, HvacMonitor._handle_values)
+                handler(self, frame, name, is_ack, values)
             devicestr = frames.ParsedFrame.get_printable_address(addr)
             return (f'{devicestr}_{name}', rest)
         return (None, None)
 
+    def _handle_devinfo(self, frame, name, is_ack, values):
+        if is_ack:
+            sa = frames.ParsedFrame.get_printable_address(frame.source)
+            self.DEVINFO.labels(name=self.name, device=sa).info(values)
+
+    def _handle_temperatures(self, frame, name, is_ack, values):
+        sa = frames.ParsedFrame.get_printable_address(frame.source)
+        for s in values['TempSensors']:
+            state = self.SENSOR_STATES.get(s['State']) or str(s['State'])
+            stype = self.SENSOR_TYPES.get(s['Type']) or str(s['Type'])
+            temp = s['TempTimes16']
+            self.TEMPSENSORS.labels(
+                name=self.name, device=sa, state=state, sensor_type=stype
+            ).set(temp / 16.0)
+
+    def _tablename(self, name):
+        """Returns the gauge table name for a parsed register name."""
+        (basename, paren, num) = name.partition('(')
+        return self.TABLE_NAME_MAP.get(basename, basename)
+
+    def _handle_zoneparams(self, frame, name, is_ack, values):
+        tablename = self._tablename(name)
+        for (k, v, labelpair) in _flatten_items(values):
+            if is_ack:
+                self._set_zonename(k, v)
+            self._set_gauge(tablename, k, v, labelpair)
+
+    def _handle_values(self, frame, name, is_ack, values):
+        tablename = self._tablename(name)
+        for (k, v, labelpair) in _flatten_items(values):
+            self._set_gauge(tablename, k, v, labelpair)
+
+    # registers that need more than _handle_values, by parsed register name
+    _HANDLERS = {
+        'DeviceInfo(0104)': _handle_devinfo,
+        'Temperatures(0302)': _handle_temperatures,
+        'TStatZoneParams(3b03)': _handle_zoneparams,
+    }
+
     def set_store_frames(self, storethem):
         """When storethem is True, run() will call store_frame() for each
         frame it processes.
@@ -150,11 +255,13 @@ class HvacMonitor:
         if storethem:
             self.register_to_rest = {}
             self.framedata_to_index = {}
-            self.frames = []  # squashed
+            self.frames = deque(maxlen=HvacMonitor.MAX_SEQUENCE_LENGTH)  # squashed
         self.store_frames = storethem
 
-    def store_frame(self, frame, name, rest):
-        """If rest is a statechange on name, store the frame."""
+    def store_frame(self, frame, name, rest, timestamp=None):
+        """If rest is a statechange on name, store the frame. timestamp is
+        when the frame was read, defaulting to now.
+        """
         (lastrest, lastframe) = self.register_to_rest.get(name, (None, None))
         self.register_to_rest[name] = (rest, frame)
         if (not rest) or lastrest == rest:
@@ -166,160 +273,175 @@ class HvacMonitor:
         w = ''
         if frame.func == frames.Function.WRITE:
             w = f'WRITE({frames.ParsedFrame.get_printable_address(frame.source)}):'
-        self.frames.append((time.time(), w + name, index))
+        self.frames.append((timestamp or time.time(), w + name, index))
 
     def send_with_response(self, frame, timeout=1):
         """Send frame. Wait up to timeout seconds for a response and return it.
         Returns None on timeout or if the frame could not be sent due to a
         synchronization issue.
         """
-        q = SimpleQueue()
-        self.send_queue.put((frame, q, time.time() + timeout))
-        return q.get()
+        reply = Future()
+        self.send_queue.put((frame, reply, time.monotonic() + timeout))
+        return reply.result()
 
     def _process_send_queue(self, ackframe):
         if self.pending_frame:
-            (pf, pq, pexpires) = self.pending_frame
+            (pf, preply, pexpires) = self.pending_frame
             if pf.source == ackframe.dest and pf.dest == ackframe.source:
-                pq.put(ackframe)
+                preply.set_result(ackframe)
                 self.pending_frame = None
-            elif pexpires < time.time():
-                pq.put(None)
+            elif pexpires < time.monotonic():
+                preply.set_result(None)
                 self.pending_frame = None
         if ackframe.func == frames.Function.ACK06 and not self.pending_frame:
             try:
                 pend = self.send_queue.get_nowait()
-                if not self.bus.write(pend[0].framebytes):
-                    LOGGER.info(f'{self.name} unable to write {pend[0]}; retrying')
-                    self.send_queue.put(pend)  # retry
-                else:
-                    self.pending_frame = (frames.ParsedFrame(pend[0].framebytes), pend[1], pend[2])
             except Empty:
-                pass
+                return
+            bus = self.bus  # None while the reader thread is reconnecting
+            try:
+                written = bus is not None and bus.write(pend[0].framebytes)
+            except OSError:
+                written = False  # the reader thread will reconnect
+            if not written:
+                LOGGER.info(f'{self.name} unable to write {pend[0]}; retrying')
+                self.send_queue.put(pend)  # retry
+            else:
+                self.pending_frame = (frames.ParsedFrame(pend[0].framebytes, crc_valid=True), pend[1], pend[2])
 
-    ZONE_RE = re.compile(r'Zone([1-8])(.*)')
     def _set_zonename(self, itemname, v):
-        zmatch = HvacMonitor.ZONE_RE.match(itemname)
-        zone = int(zmatch.group(1)) if zmatch else None
         if isinstance(v, str):
-            if zone and zmatch.group(2) == 'Name':
+            (zone, iname) = _zone_item(itemname)
+            if zone and iname == 'Name':
                 # then itemname is a zone name, e.g. Zone1Name
                 with HvacMonitor.CV:
                     if self.zone_to_name[zone-1] != v:
                         LOGGER.info(f'{self.name} zone {zone} has name {v}')
                         self.zone_to_name[zone-1] = v
-
-    def _set_gauge(self, tablename, itemname, v, labelpair=None):
-        if isinstance(v, list):
-            if v and (v[0].get('Tag') is not None) and labelpair is None:
-                for d in v:
-                    tag = str(d['Tag'])
-                    for (subkey, val) in d.items():
-                        if subkey != 'Tag':
-                            self._set_gauge(tablename, f'{itemname}_{subkey}', val, ('tag', tag))
-            return
-        elif isinstance(v, str):
-            # TODO: emit as a label?
-            return
-        desc = ''
-        divisor = 1
-        (pre, times, post) = itemname.partition('Times7')
-        if times and not post:
-            itemname = pre
-            divisor = 7.0
-        (pre, times, post) = itemname.partition('Times16')
-        if times and not post:
-            itemname = pre
-            divisor = 16.0
-        for words in ['RPM', 'CFM']:
-            (pre, word, post) = itemname.partition(words)
-            if word:
-                itemname = f'{pre}{"_" if pre else ""}{word.lower()}{"_" if post else ""}{post}'
-                break
-        with HvacMonitor.CV:
-            def getgauge(name, desc, morelabels=[]):
-                name = name.replace('(', '').replace(')', '')
+                        self.gauge_setters.clear()  # zone gauges are labeled by name
+
+    @staticmethod
+    def _getgauge(name, desc, morelabels=[]):
+        # Gauges are shared by all monitors and almost always exist already,
+        # so we only take the lock to create one.
+        gauge = HvacMonitor.GAUGES.get(name)
+        if gauge is None:
+            with HvacMonitor.CV:
                 gauge = HvacMonitor.GAUGES.get(name)
                 if gauge is None:
                     gauge = prometheus_client.Gauge(name, desc, ['name'] + morelabels)
                     HvacMonitor.GAUGES[name] = gauge
-                return gauge
+        return gauge
 
-            if itemname == 'Mode' and not tablename:
+    def _set_gauge(self, tablename, itemname, v, labelpair=None):
+        setter = self.gauge_setters.get((tablename, itemname, labelpair, type(v)))
+        if setter is not None:
+            (child, divisor) = setter
+            child.set(v / divisor)
+            return
+        if isinstance(v, (list, str)):
+            # lists were flattened by _flatten_items; TODO: emit strings as labels?
+            return
+        desc = ''
+        if itemname == 'Mode' and not tablename:
+            assert not labelpair, labelpair
+            decoded = _MODE_TABLE[v] if 0 <= v < 256 else _decode_mode(v)
+            if decoded is None:
+                raise ValueError(f'{v & 0x1f} is not a valid HvacMode')
+            (modename, mode, stage, state, s) = decoded
+            HvacMonitor.MODE.labels(name=self.name, state=modename).set(mode)
+            if self.mode_metrics is None:
+                self.mode_metrics = (HvacMonitor.STAGE.labels(name=self.name),
+                                     HvacMonitor.STATE.labels(name=self.name),
+                                     HvacMonitor.HVACSTATE.labels(name=self.name))
+            (stage_gauge, state_gauge, state_enum) = self.mode_metrics
+            stage_gauge.set(stage)
+            state_gauge.set(state)
+            state_enum.state(s)
+        else:
+            (gaugename, zone, divisor) = _gauge_name(tablename, itemname)
+            if zone:
                 assert not labelpair, labelpair
-                # the lower 5 bits are the mode; upper bits are stage number
-                mode = v & 0x1f
-                modegauge = getgauge('finitude_mode', 'current operating mode', ['state'])
-                s = registers.HvacMode(mode).name
-                modegauge.labels(name=self.name, state=s).set(mode)
-                stage = v >> 5
-                stagegauge = getgauge('finitude_stage', 'current operating stage')
-                stagegauge.labels(name=self.name).set(stage)
-                # FIXME: state and enum are incorrect if mode is AUTO and we are cooling
-                state = stage * (-1 if mode == registers.HvacMode.COOL else 1)
-                stateg = getgauge('finitude_state', 'current operating state')
-                stateg.labels(name=self.name).set(state)
-                s = 'off' if state == 0 else 'cool' if state < 0 else 'heat'
-                HvacMonitor.HVACSTATE.labels(name=self.name).state(s)
+                zname = self.zone_to_name[zone-1].strip(' \0')
+                if not zname:
+                    LOGGER.debug('ignoring %s in %d: no zonename', gaugename, zone)
+                    return
+                gauge = HvacMonitor._getgauge(gaugename, desc, morelabels=['zone', 'zonename'])
+                child = gauge.labels(name=self.name, zone=str(zone), zonename=zname)
+            elif labelpair:
+                gauge = HvacMonitor._getgauge(gaugename, desc, morelabels=[labelpair[0]])
+                kwargs = { 'name': self.name, labelpair[0]: labelpair[1] }
+                child = gauge.labels(**kwargs)
             else:
-                zmatch = HvacMonitor.ZONE_RE.match(itemname)
-                zone = int(zmatch.group(1)) if zmatch else None
-                iname = zmatch.group(2) if zmatch else itemname
-                if tablename:
-                    gaugename = f'finitude_{tablename}_{iname.lower()}'
-                else:
-                    gaugename = f'finitude_{iname}'
-                if zone:
-                    assert not labelpair, labelpair
-                    gauge = getgauge(gaugename, desc, morelabels=['zone', 'zonename'])
-                    zname = self.zone_to_name[zone-1].strip(' \0')
-                    if zname:
-                        gauge.labels(
-                            name=self.name, zone=str(zone), zonename=zname
-                        ).set(v / divisor)
-                    else:
-                        LOGGER.debug(f'ignoring {gaugename} in {zone}: no zonename')
-                else:
-                    if labelpair:
-                        gauge = getgauge(gaugename, desc, morelabels=[labelpair[0]])
-                        kwargs = { 'name': self.name, labelpair[0]: labelpair[1] }
-                        gauge.labels(**kwargs).set(v / divisor)
-                    else:
-                        gauge = getgauge(gaugename, desc)
-                        gauge.labels(name=self.name).set(v / divisor)
+                gauge = HvacMonitor._getgauge(gaugename, desc)
+                child = gauge.labels(name=self.name)
+            self.gauge_setters[(tablename, itemname, labelpair, type(v))] = (child, divisor)
+            child.set(v / divisor)
 
     def _report_crc_error(self):
         if self.synchronized:
             self.synchronized = False
-            HvacMonitor.DESYNC_COUNT.labels(name=self.name).inc()
+            self.desync_count.inc()
 
-    def run(self):
-        self.open()  # at startup, fail if we can't open
-        while True:
+    def read_frames(self, processor):
+        """Reads frames from the bus onto frame_queue, reconnecting on error.
+        This thread does nothing else, so processing never delays a read.
+        Returns if processor, the thread taking frames off the queue, exits.
+        """
+        while processor.is_alive():
             try:
                 if self.stream is None:
                     self.open()
-                frame = frames.ParsedFrame(self.bus.read())
-                (name, rest) = self.process_frame(frame)
-                if self.store_frames:
-                    HvacMonitor.FRAME_COUNT.labels(
+                framebytes = self.bus.read()
+                # set here, not when processing, so it tracks the bus itself;
+                # _report_crc_error clears it on this same thread
+                self.synchronized = True
+                item = (time.time(), frames.ParsedFrame(framebytes, crc_valid=True))
+                while True:
+                    try:
+                        self.frame_queue.put(item, timeout=1)
+                        break
+                    except Full:
+                        if not processor.is_alive():
+                            break
+            except (OSError, frames.FinitudeError):
+                # drop the bus before logging, so the processor can't write to it
+                self.stream, self.bus = None, None
+                LOGGER.exception('exception in frame reader, reconnecting')
+                time.sleep(1) # rate limiting
+        LOGGER.error(f'{self.name} frame processor exited; reader stopping')
+
+    def run(self):
+        self.open()  # at startup, fail if we can't open
+        threading.Thread(target=self.read_frames, args=(threading.current_thread(),),
+                         name=f'{self.name}-reader').start()
+        while True:
+            (timestamp, frame) = self.frame_queue.get()
+            (name, rest) = self.process_frame(frame)
+            if self.store_frames:
+                register = name or frame.get_register() or 'unknown'
+                key = (frame.source, frame.dest, frame.func, register)
+                counter = self.frame_counters.get(key)
+                if counter is None:
+                    counter = HvacMonitor.FRAME_COUNT.labels(
                         name=self.name,
                         source=frames.ParsedFrame.get_printable_address(frame.source),
                         dest=frames.ParsedFrame.get_printable_address(frame.dest),
                         func=frame.get_function_name(),
-                        register=name or frame.get_register() or 'unknown',
-                    ).inc()
-                    self.store_frame(frame, name, rest)
-                else:
-                    HvacMonitor.FRAME_COUNT.labels(name=self.name).inc()
-                if frame.func in (frames.Function.ACK06,
-                                  frames.Function.ACK02,
-                                  frames.Function.NACK):
-                    self._process_send_queue(frame)
-            except (OSError, frames.CarrierError):
-                LOGGER.exception('exception in frame processor, reconnecting')
-                self.stream, self.bus = None, None
-                time.sleep(1) # rate limiting
+                        register=register,
+                    )
+                    self.frame_counters[key] = counter
+                counter.inc()
+                self.store_frame(frame, name, rest, timestamp)
+            else:
+                if self.frame_count is None:
+                    self.frame_count = HvacMonitor.FRAME_COUNT.labels(
+                        name=self.name, source='', dest='', func='', register='')
+                self.frame_count.inc()
+            if frame.func in (frames.Function.ACK06,
+                              frames.Function.ACK02,
+                              frames.Function.NACK):
+                self._process_send_queue(frame)
 
 class Finitude:
     def __init__(self, config):
@@ -10,7 +10,9 @@ and https://github.com/acd/infinitive/issues/9
 
 import serial
 
-import select
+import array
+import functools
+import selectors
 import socket
 import struct
 import sys
@@ -18,7 +20,7 @@ import time
 
 from enum import IntEnum
 
-from .registers import FanMode, HvacMode, Field, REGISTER_INFO, REPEATED_8_ZONES
+from .registers import FanMode, HvacMode, Field, REGISTER_INFO, REPEATED_8_ZONES, ZONE_STRUCTS
 
 
 class FinitudeError(Exception):
@@ -27,7 +29,8 @@ class FinitudeError(Exception):
 
 class SerialStream:
   """Connect to a serial port."""
-  
+  __slots__ = ('path', 'ser')
+
   def __init__(self, path):
     self.path = path
     self.ser = None
@@ -38,14 +41,20 @@ class SerialStream:
     self.ser = serial.Serial(self.path, 38400)
 
   def read(self, numbytes):
-    return self.ser.read(numbytes)
+    """Blocks until numbytes are read, but also returns anything else already waiting."""
+    return self.ser.read(max(numbytes, self.ser.in_waiting))
 
   def write(self, data):
-    self.ser.write(data)
+    ser = self.ser  # another thread may close the stream
+    if ser is None:
+      raise OSError(f'{self.path} is closed')
+    ser.write(data)
 
   @property
   def can_read(self):
-    return self.ser.in_waiting > 0
+    """False once the stream is closed."""
+    ser = self.ser
+    return ser is not None and ser.in_waiting > 0
 
   def close(self):
     self.ser.close()
@@ -54,37 +63,56 @@ class SerialStream:
 
 class SocketStream:
   """Connect to a TCPv4 socket."""
-  
+  __slots__ = ('hostport', 'timeout', 'sock', 'selector')
+
   def __init__(self, host, port, timeout=10):
     # create a blocking TCP connection
     self.hostport = (host, port)
     self.timeout = timeout
     self.sock = None
+    self.selector = None
     self.open()
 
   def open(self):
     assert self.sock is None, self.sock
     self.sock = socket.create_connection(self.hostport, timeout=self.timeout)
+    # frames are tiny and the bus expects a write right after an ACK06
+    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # registered once so can_read doesn't rebuild fd sets on every call
+    self.selector = selectors.DefaultSelector()
+    self.selector.register(self.sock, selectors.EVENT_READ)
 
   def read(self, numbytes):
-    """Raises socket.timeout if no data is received within the timeout.
+    """Returns at least one byte and possibly more than numbytes, whatever
+    has arrived. Raises socket.timeout if no data is received within the timeout.
     If data is received but synchronization does not occur, the timeout will not trigger.
     If read() returns b'', the remote end closed the connection cleanly.
     """
-    b = self.sock.recv(numbytes)
+    b = self.sock.recv(max(numbytes, 4096))
     if not b:
       self.close()
     return b
 
   def write(self, data):
-    self.sock.sendall(data)
+    sock = self.sock  # another thread may close the stream
+    if sock is None:
+      raise OSError(f'{self.hostport} is closed')
+    sock.sendall(data)
 
   @property
   def can_read(self):
-    (readable, writable, xable) = select.select([self.sock], [], [], timeout=0)
-    return len(readable) > 0
+    """False once the stream is closed."""
+    selector = self.selector
+    if selector is None:
+      return False
+    try:
+      return len(selector.select(timeout=0)) > 0
+    except ValueError:  # closed while we were selecting
+      return False
 
   def close(self):
+    self.selector.close()
+    self.selector = None
     self.sock.close()
     self.sock = None
 
@@ -116,22 +144,25 @@ class Bus:
   is no thermostat, listen_before_write must be false as otherwise we'll
   wait forever.
   """
+  __slots__ = ('stream', 'listen_before_write', 'report_crc_error', 'lastfunc', 'buf')
 
   def __init__(self, stream, listen_before_write=True, report_crc_error=None):
     self.stream = stream
     self.listen_before_write = listen_before_write
     self.report_crc_error = report_crc_error
     self.lastfunc = None
-    self.buf = b''
+    self.buf = bytearray()
 
   def _read_until(self, size):
-    """Read data until self.buf is at least size characters.
+    """Read data until self.buf is at least size characters. The stream may
+    give us more than we ask for, which saves a read per frame when
+    several frames arrive together.
     """
     while len(self.buf) < size:
       readbytes = self.stream.read(size - len(self.buf))
       if not readbytes:
         raise FinitudeError('connection closed [no data] while reading')
-      self.buf += readbytes
+      self.buf.extend(readbytes)
 
   def read(self):
     """Discard data until we find a valid frame boundary. Return the first valid
@@ -140,32 +171,39 @@ class Bus:
     SocketStream may raise socket.timeout. Raises FinitudeError if remote end
     closes the connection.
     """
-    # make sure we have enough data in the buffer to check for the size of the frame
-    self._read_until(10)
-	
-    crcer = CRC16()
+    buf = self.buf  # modified only in place, so a local alias stays current
     while True:
-      frame_len = self.buf[4] + 10
-      self._read_until(frame_len)
-      frame = self.buf[:frame_len]
-      crc = crcer.calculate(frame)
-      if crc == 0:
-        self.buf = self.buf[frame_len:]
-        self.lastfunc = frame[7]
-        return frame
+      # make sure we have enough data in the buffer to check the header of the frame
+      self._read_until(10)
+      # PID and EXT are always zero, so a nonzero byte there rules out a
+      # frame boundary without reading the rest of the frame or running the CRC
+      if buf[5] == 0 and buf[6] == 0:
+        frame_len = buf[4] + 10
+        self._read_until(frame_len)
+        frame = buf[:frame_len]
+        crc = crc16(frame)
+        if crc == 0:
+          del buf[:frame_len]
+          self.lastfunc = frame[7]
+          return bytes(frame)
       if self.report_crc_error:
         self.report_crc_error()
-      self.buf = self.buf[1:]
+      # skip to the next offset whose PID and EXT bytes are both zero; if
+      # there is none, only the last 6 offsets could still start a frame.
+      # Deleting from the front of a bytearray only advances its start.
+      pidext = buf.find(b'\0\0', 6)
+      del buf[:pidext - 5 if pidext != -1 else len(buf) - 6]
 
   def write(self, data):
-    """If data can be read without blocking, return False immediately.
+    """If data can be read without blocking, or we have already read data
+    that is not yet part of a frame, return False immediately.
     If the last frame was something other than ACK06 and we are to listen
     before writing (thermostat-friendly), return False immediately. Otherwise
     write data and return True. Note that this relies on there being a
     thermostat in the system to make requests that are ACKed.
     """
     assert data
-    if not self.stream.can_read:
+    if not self.buf and not self.stream.can_read:
       if self.lastfunc == Function.ACK06 or not self.listen_before_write:
         self.stream.write(data)
         return True
@@ -188,76 +226,62 @@ class Function(IntEnum):
   LIST = 0x75
 
 
+# indexed by function code, so naming a frame's function needs no enum lookup
+_FUNCTION_NAMES = [f'UNKNOWN({f})' for f in range(256)]
+for _f in Function:
+  _FUNCTION_NAMES[_f] = _f.name
+_FUNCTION_NAMES = tuple(_FUNCTION_NAMES)
+
+
 class AssembledFrame:
+  __slots__ = ('frame', 'crc', 'framebytes')
+
   def __init__(self, dest, source, func, data=b'', crc=None, pid=0, ext=0):
     """Dest and source are each bytes objects of length 2. pid and ext
     are always zero in observation."""
     length = len(data)
     assert length <= 255, length
-    self.frame = b''.join([dest, source, bytes([length, pid, ext, func]), data])
-    crcer = CRC16()
-    self.crc = crcer.calculate(self.frame)
+    assert len(dest) == 2 and len(source) == 2, (dest, source)
+    self.frame = ParsedFrame.HEADER.pack(dest, source, length, pid, ext, func) + data
+    self.crc = crc16(self.frame)
     if crc is not None:
       assert crc == self.crc, (crc, self.crc)
-
-  @property
-  def framebytes(self):
-    return self.frame + struct.pack('<H', self.crc)
+    self.framebytes = self.frame + struct.pack('<H', self.crc)
 
   def __str__(self):
-    return 'AssembledFrame:' + str(ParsedFrame(self.framebytes))
+    return 'AssembledFrame:' + str(ParsedFrame(self.framebytes, crc_valid=True))
 
 
 class ParsedFrame:
-  def __init__(self, framebytes):
-    self.framebytes = framebytes
-    # frame is 8 byte header, self.length data bytes, and 2 byte CRC
-    assert len(self.framebytes) == 8 + self.length + 2, (len(self.framebytes), self.length+10)
-
-  @property
-  def dest(self):
-    """First byte is the device class, second byte is the bus. Bus is always 0x1."""
-    return self.framebytes[0:2]
-
-  @property
-  def source(self):
-    """First byte is the device class, second byte is the bus. Bus is always 0x1."""
-    return self.framebytes[2:4]
-
-  @property
-  def length(self):
-    return self.framebytes[4]
-
-  @property
-  def pid(self):
-    """PID is always zero."""
-    return self.framebytes[5]
+  """The header fields are unpacked once, when the frame is constructed.
 
-  @property
-  def ext(self):
-    """EXT is always zero."""
-    return self.framebytes[6]
+  dest and source: first byte is the device class, second byte is the bus.
+  Bus is always 0x1. pid and ext are always zero.
+  """
+  __slots__ = ('framebytes', 'dest', 'source', 'length', 'pid', 'ext', 'func', 'data',
+               '_crc_valid')
 
-  @property
-  def func(self):
-    return self.framebytes[7]
+  HEADER = struct.Struct('>2s2sBBBB')
 
-  @property
-  def data(self):
-    return self.framebytes[8:8+self.length]
+  def __init__(self, framebytes, crc_valid=None):
+    """Pass crc_valid=True for frames already checked, e.g. from Bus.read()."""
+    self.framebytes = framebytes
+    (self.dest, self.source, self.length, self.pid, self.ext, self.func) = self.HEADER.unpack_from(framebytes)
+    # frame is 8 byte header, self.length data bytes, and 2 byte CRC
+    assert len(self.framebytes) == 8 + self.length + 2, (len(self.framebytes), self.length+10)
+    self.data = framebytes[8:8+self.length]
+    self._crc_valid = crc_valid
 
   def is_crc_valid(self):
-    crcer = CRC16()
-    dataend = 8 + self.length
-    calculated_crc = crcer.calculate(self.framebytes[0:dataend])
-    stored_crc = struct.unpack('<H', self.framebytes[dataend:dataend+2])[0]
-    return calculated_crc == stored_crc
+    if self._crc_valid is None:
+      dataend = 8 + self.length
+      calculated_crc = crc16(self.framebytes[0:dataend])
+      stored_crc = struct.unpack_from('<H', self.framebytes, dataend)[0]
+      self._crc_valid = calculated_crc == stored_crc
+    return self._crc_valid
 
   def get_function_name(self):
-    try:
-      return Function(self.func).name
-    except ValueError:
-      return f'UNKNOWN({self.func})'
+    return _FUNCTION_NAMES[self.func]
 
   @staticmethod
   def get_printable_address(source_or_dest):
@@ -273,10 +297,8 @@ class ParsedFrame:
             self.func == Function.WRITE or
             self.func == Function.ACK06), self.func
     assert self.length >= 3, self.length
-    k = bytestohex(self.data[0:3])
-    k2 = k[2:] if k.startswith('00') else k
-    (name, fmt) = REGISTER_INFO.get(k, ('register', []))
-    return (f'{name}({k2})', fmt)
+    (printable, fmt, bare) = _register_info(bytes(self.data[0:3]))
+    return (printable, fmt)
 
   def get_register(self):
     """Returns the bare register name from REGISTER_INFO if any, or a string
@@ -285,9 +307,7 @@ class ParsedFrame:
     if (self.func == Function.READ or
         self.func == Function.WRITE or
         self.func == Function.ACK06) and self.length >= 3:
-      k = bytestohex(self.data[0:3])
-      name = REGISTER_INFO.get(k, (None, []))[0]
-      return name if name is not None else k[2:] if k.startswith('00') else k
+      return _register_info(bytes(self.data[0:3]))[2]
     return None
 
   def get_printable_register(self):
@@ -315,12 +335,18 @@ class ParsedFrame:
       assert fieldname[0] not in values, (values, (reps, field, *fieldname))
       values[fieldname[0]] = value
       return newcursor
-    for (reps, field, *fieldname) in fmt:
+    for (i, (reps, field, *fieldname)) in enumerate(fmt):
       if reps == REPEATED_8_ZONES:
         assert len(fieldname) == 1, (reps, field, *fieldname)
-        for zone in range(8):
-          (value, cursor) = Field.parse(cursor, 1, field)
-          values[f'Zone{zone+1}{fieldname[0]}'] = value
+        zs = ZONE_STRUCTS.get(field)
+        if zs is not None and len(cursor) >= zs.size:
+          for (zone, value) in enumerate(zs.unpack_from(cursor)):
+            values[f'Zone{zone+1}{fieldname[0]}'] = value
+          cursor = cursor[zs.size:]
+        else:  # names, and short cursors, which fail in Field.parse as before
+          for zone in range(8):
+            (value, cursor) = Field.parse(cursor, 1, field)
+            values[f'Zone{zone+1}{fieldname[0]}'] = value
       elif field == Field.UNKNOWN:
         assert not fieldname, (reps, field, *fieldname)
         assert reps > 0, (reps, field, *fieldname)
@@ -334,15 +360,12 @@ class ParsedFrame:
         assert reps == 0, (reps, field, *fieldname)
         assert len(fieldname) == 1, (reps, field, *fieldname)
         dictname = fieldname[0]
+        repfmt = fmt[i+1:]  # the fields that repeat
         allreps = []
         while cursor:
-          found = False
           v = {}
-          for (reps, field, *fieldname) in fmt:
-            if found:
-              cursor = parseone(v, cursor, reps, field, *fieldname)
-            elif field == Field.REPEATING:
-              found = True
+          for (reps, field, *fieldname) in repfmt:
+            cursor = parseone(v, cursor, reps, field, *fieldname)
           assert v, (fmt, cursor)
           allreps.append(v)
         values[dictname] = allreps
@@ -370,14 +393,29 @@ class ParsedFrame:
 
 
 def bytestohex(rbytes):
-  return ''.join(['%02x' % b for b in rbytes]) if rbytes else str(rbytes)
+  return rbytes.hex() if rbytes else str(rbytes)
+
+
+@functools.lru_cache(maxsize=1024)
+def _register_info(prefix):
+  """Returns (printable name, format, bare name) for the 3 bytes that begin
+  a register frame's data. A bus uses a few dozen registers, so this is
+  almost always a cache hit.
+  """
+  k = bytestohex(prefix)
+  k2 = k[2:] if k.startswith('00') else k
+  entry = REGISTER_INFO.get(k)
+  if entry is None:
+    return (f'register({k2})', [], k2)
+  (name, fmt) = entry
+  return (f'{name}({k2})', fmt, name if name is not None else k2)
 
 
 class CRC16:
   """Table based CRC calculation from
      http://www.digi.com/wiki/developer/index.php/Python_CRC16_Modbus_DF1
   """
-  TABLE = (
+  TABLE = array.array('H', (
     0x0000, 0xC0C1, 0xC181, 0x0140, 0xC301, 0x03C0, 0x0280, 0xC241,
     0xC601, 0x06C0, 0x0780, 0xC741, 0x0500, 0xC5C1, 0xC481, 0x0440,
     0xCC01, 0x0CC0, 0x0D80, 0xCD41, 0x0F00, 0xCFC1, 0xCE81, 0x0E40,
@@ -410,14 +448,51 @@ class CRC16:
     0x4E00, 0x8EC1, 0x8F81, 0x4F40, 0x8D01, 0x4DC0, 0x4C80, 0x8C41,
     0x4400, 0x84C1, 0x8581, 0x4540, 0x8701, 0x47C0, 0x4680, 0x8641,
     0x8201, 0x42C0, 0x4380, 0x8341, 0x4100, 0x81C1, 0x8081, 0x4040
-  )
+  ))
 
-  def _calculate_one_cycle(self, b, crc):
-    """Given a new byte and previous CRC-16, return the new CRC-16."""
-    crc = (crc >> 8) ^ self.TABLE[(crc ^ b) & 0xFF]
-    return crc & 0xFFFF
+  @staticmethod
+  def calculate(bytesin, crc=0):
+    """bytesin may be any bytes-like object or an iterable of byte values."""
+    try:
+      memoryview(bytesin)
+    except TypeError:  # not a buffer, e.g. a list of ints: go byte by byte
+      for b in bytesin:
+        crc = (crc >> 8) ^ CRC16.TABLE[(crc ^ b) & 0xFF]
+      return crc
+    return crc16(bytesin, crc)
+
+
+def _make_pair_table():
+  """Because the register is exactly 16 bits wide, folding in two bytes at
+  once leaves nothing of the old CRC except what the two table steps shift
+  through. So the CRC of a little-endian 16-bit word w is just
+  TABLE2[crc ^ w], one lookup per two bytes instead of two.
+  """
+  table = CRC16.TABLE
+  def twocycles(crc):
+    crc = (crc >> 8) ^ table[crc & 0xFF]
+    return (crc >> 8) ^ table[crc & 0xFF]
+  return array.array('H', [twocycles(w) for w in range(65536)])
 
-  def calculate(self, bytesin, crc=0):
-    for b in bytesin:
-      crc = self._calculate_one_cycle(b, crc)
-    return crc
+
+_TABLE2 = _make_pair_table()
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def crc16(bytesin, crc=0):
+  """Returns the CRC-16 (Modbus polynomial) of bytesin, starting from crc.
+  Running it over a frame including its trailing CRC yields 0 if the frame is valid.
+  bytesin may be any bytes-like object; others raise TypeError.
+  """
+  view = memoryview(bytesin).cast('B')  # raw bytes, whatever the buffer's format
+  evenlen = len(view) & ~1
+  words = array.array('H')
+  words.frombytes(view[:evenlen])
+  if _BIG_ENDIAN:
+    words.byteswap()
+  table2 = _TABLE2
+  for w in words:
+    crc = table2[crc ^ w]
+  if evenlen != len(view):
+    crc = (crc >> 8) ^ CRC16.TABLE[(crc ^ view[-1]) & 0xFF]
+  return crc
@@ -68,6 +68,13 @@ class Field(Enum):
 
 REPEATED_8_ZONES = -1
 
+# REPEATED_8_ZONES fields of these types are unpacked all at once
+ZONE_STRUCTS = {
+  Field.UINT8: struct.Struct('>8B'),
+  Field.INT8: struct.Struct('>8b'),
+  Field.UINT16: struct.Struct('>8H'),
+}
+
 _REGINFO = [
   (1, Field.UINT8, 'Unknown1'),  # often 0
   (1, Field.UINT8, 'Unknown2'),  # 0x20, 0x21, 0x30, ...
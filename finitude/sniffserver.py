@@ -61,7 +61,7 @@ def start_sniffserver(port, monitors):
                 assert index_frame[0][0] == 1, index_frame[0]
                 lastindex_by_name = {}
                 outframes = []
-                for (t, name, index) in m.frames:
+                for (t, name, index) in list(m.frames):  # snapshot; the deque is appended to as we go
                     if index-1 >= len(index_frame):
                         break  # another frame came in while we were running
                     last = lastindex_by_name.get(name)
@@ -113,8 +113,7 @@ def start_sniffserver(port, monitors):
             system = fs['system'].value
             register = bytes([0]) + convert_word_to_bytes(fs['register'].value)
             mask = (bytes([0]) + convert_word_to_bytes(fs['mask'].value)) if 'mask' in fs else b''
-            hex = fs['data'].value if 'data' in fs else b''
-            data = bytes([int(hi + lo, 16) for (hi, lo) in zip(*([iter(hex)]*2))])
+            data = bytes.fromhex(fs['data'].value) if 'data' in fs else b''
             frame = frames.AssembledFrame(convert_word_to_bytes(fs['dest'].value),
                                           convert_word_to_bytes(fs['source'].value),
                                           func,
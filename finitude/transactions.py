@@ -2,7 +2,9 @@
 transactions.py -- read or write a register from/to a device on the bus
 """
 
-from .frames import AssembledFrame, Function, FinitudeError
+import sys
+
+from .frames import AssembledFrame, Bus, Function, FinitudeError, ParsedFrame, StreamFactory
 
 
 class RetryableFinitudeError(FinitudeError):
@@ -11,18 +13,18 @@ class RetryableFinitudeError(FinitudeError):
 
 
 class FrameToSend:
+    __slots__ = ('bus', 'frame', 'sent')
+
     def __init__(self, bus, source, dest, funcstr, register='', mask='', data=''):
         self.bus = bus
-        for f in Function:
-            if f.name == funcstr:
-                func = f.value
-                break
-        else:
+        f = Function.__members__.get(funcstr)
+        if f is None:
             raise Exception(f'unknown function {funcstr}')
+        func = f.value
 
         regb = (bytes([0]) + FrameToSend.convert_word_to_bytes(register)) if register else b''
         maskb = (bytes([0]) + FrameToSend.convert_word_to_bytes(mask)) if mask else b''
-        datab = bytes([int(hi + lo, 16) for (hi, lo) in zip(*([iter(data)]*2))])
+        datab = bytes.fromhex(data)
         self.frame = AssembledFrame(
             FrameToSend.convert_word_to_bytes(dest),
             FrameToSend.convert_word_to_bytes(source),
@@ -47,10 +49,9 @@ class FrameToSend:
 
     @staticmethod
     def convert_word_to_bytes(word):
-        if len(addr) != 4:
-            raise FinitudeError(f'{addr} is invalid')
-        assert int(addr, 16)  # raises ValueError if not valid hex
-        return bytes([0, int(addr[0:2], 16), int(addr[2:], 16)])
+        if len(word) != 4:
+            raise FinitudeError(f'{word} is invalid')
+        return bytes.fromhex(word)  # raises ValueError if not valid hex
 
 
 def main(args):
@@ -91,7 +92,7 @@ Usage: {args[0]} URI_of_bus_adapter dest source WRITE register [mask] data''', f
         pending = None
 
     while True:
-        frame = ParsedFrame(bus.read())
+        frame = ParsedFrame(bus.read(), crc_valid=True)
         print(frame)
         if pending and pending.process(frame):
             pending = None